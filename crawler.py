@@ -13,13 +13,76 @@ Flags:
 
 from absl import app, flags
 import aiohttp
+from aiohttp.resolver import AsyncResolver
 import asyncio
-from bs4 import BeautifulSoup
-from typing import Callable, List, Set
-from urllib.parse import urldefrag, urljoin, urlparse
+from selectolax.lexbor import LexborHTMLParser
+import collections
+import concurrent.futures
+import enum
+import functools
+import os
+import posixpath
+from pybloom_live import ScalableBloomFilter
+import re
+import socket
+import sys
+from typing import Callable, Iterable, List, Set
+from urllib.parse import parse_qsl, urlencode, urljoin, urlsplit, urlunsplit
+import xxhash
+import yarl
+
 
-MONITOR_SLEEP_MS = 250
 DEFAULT_NUM_WORKERS = 5
+# How many fetches may be in flight per worker; lets network I/O run
+# ahead of the parsing pipeline.
+FETCHES_PER_WORKER = 4
+# Pages larger than this are truncated before parsing.
+MAX_PAGE_BYTES = 2 * 1024 * 1024
+# How many queued urls a worker drains and fetches concurrently per
+# pass, amortizing the await on queue.get across the batch.
+WORKER_BATCH_SIZE = 8
+# Queue capacity per worker. Links beyond this spill into the finding
+# worker's pending buffer and are fed back in as getters make room,
+# keeping the shared queue (and its wakeup bookkeeping) small on high
+# fan-out crawls. Workers never block to enqueue: with the workers as
+# both producers and consumers, a blocking put could leave every worker
+# waiting for queue space with no one left to make any.
+QUEUE_ITEMS_PER_WORKER = 64
+# Sizing for the Bloom filter which dedups enqueued urls. At this error
+# rate a crawl may very occasionally skip a page, in exchange for the
+# dedup memory staying a few bits per url rather than a full string.
+# The filter scales itself as the crawl outgrows the initial capacity.
+DEDUP_INITIAL_CAPACITY = 100_000
+DEDUP_ERROR_RATE = 1e-5
+DNS_CACHE_TTL_SECS = 300
+KEEPALIVE_TIMEOUT_SECS = 75
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=30, connect=10, sock_read=20)
+
+# Shared empty result, so pages with no links of interest do not each
+# allocate a fresh set.
+_EMPTY_LINKS = frozenset()
+
+# Fast-path href extraction: a regex scan is an order of magnitude
+# quicker than building even a strained parse tree. Fragments are cut
+# at capture time; unquoted hrefs and other oddities are left to the
+# parser fallback.
+_A_HREF_RE = re.compile(
+    r'<a\s[^>]*?href\s*=\s*["\']([^"\'#>]+)', re.IGNORECASE)
+_BASE_HREF_RE = re.compile(
+    r'<base\s[^>]*?href\s*=\s*["\']([^"\'#>]+)', re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=None)
+def _same_site_matcher(site_name: str) -> re.Pattern:
+    """Returns a compiled matcher for hrefs which stay on the given site.
+
+    A href matches if it is relative (no scheme and no netloc) or if it is
+    an http(s) or protocol-relative url on site_name. This is equivalent
+    to, but much cheaper than, calling urlparse on every href.
+    """
+    return re.compile(
+        r'^(?:(?:https?:)?//' + re.escape(site_name) + r'(?=[/?#]|$)'
+        r'|(?!//|[A-Za-z][A-Za-z0-9+.\-]*:))', re.IGNORECASE)
 
 FLAGS = flags.FLAGS
 flags.DEFINE_string('root_url', None,
@@ -30,52 +93,245 @@ flags.DEFINE_integer('num_workers', DEFAULT_NUM_WORKERS,
 flags.mark_flag_as_required('root_url')
 
 
+class SeenSet:
+    """Tracks the urls which have already been enqueued for crawling.
+
+    Backed by a scalable Bloom filter, so dedup memory stays at a few
+    bits per url regardless of url length, at the price of a rare false
+    positive (a skipped page).
+    """
+
+    def __init__(self, urls: Iterable[str] = ()) -> None:
+        self.__filter = ScalableBloomFilter(
+            initial_capacity=DEDUP_INITIAL_CAPACITY,
+            error_rate=DEDUP_ERROR_RATE)
+        for url in urls:
+            self.add(url)
+
+    def add(self, url: str) -> bool:
+        """Adds url, returning True if it had not been seen before."""
+        return not self.__filter.add(_url_digest(url))
+
+    def __contains__(self, url: str) -> bool:
+        return _url_digest(url) in self.__filter
+
+
+def _url_digest(url: str) -> int:
+    # The Bloom filter runs its hash functions over whatever key it is
+    # given; condensing the url to a fixed 8-byte xxh3 digest first
+    # keeps that work independent of url length.
+    return xxhash.xxh3_64_intdigest(url.encode())
+
+
+class LinkQueue:
+    """A bounded FIFO queue of urls which wakes getters per batch.
+
+    asyncio.Queue.put_nowait schedules one event-loop callback per item,
+    so a page yielding N new links costs N wakeups. This queue appends a
+    whole batch to a deque in one go and then wakes at most one waiting
+    getter per appended item, so idle workers are not all scheduled just
+    to find the deque already drained. When a maxsize is given, put_many
+    pauses until getters free up space, so the queue cannot grow without
+    bound on high fan-out crawls. It keeps the task_done/join contract
+    of asyncio.Queue.
+    """
+
+    def __init__(self, maxsize: int = 0) -> None:
+        self.__maxsize = maxsize
+        self.__items = collections.deque()
+        self.__getters = collections.deque()
+        self.__not_full = asyncio.Event()
+        self.__not_full.set()
+        self.__unfinished_tasks = 0
+        self.__finished = asyncio.Event()
+        self.__finished.set()
+
+    def put_nowait(self, item: str) -> None:
+        if self.__maxsize > 0 and len(self.__items) >= self.__maxsize:
+            raise asyncio.QueueFull
+        self.__append_batch((item,))
+
+    async def put_many(self, items: Iterable[str]) -> None:
+        pending = collections.deque(items)
+        while pending:
+            while self.__maxsize > 0 and len(self.__items) >= self.__maxsize:
+                self.__not_full.clear()
+                await self.__not_full.wait()
+            pending = self.put_many_nowait(pending)
+
+    def put_many_nowait(self, items: Iterable[str]) -> collections.deque:
+        """Appends as many items as fit and returns the ones that did not.
+
+        This is the enqueue path for callers which must not block — the
+        workers feed the queue they consume from, so parking one in
+        put_many could leave no task able to free up space.
+        """
+        pending = collections.deque(items)
+        if self.__maxsize > 0:
+            batch_size = min(len(pending),
+                             self.__maxsize - len(self.__items))
+        else:
+            batch_size = len(pending)
+        self.__append_batch(pending.popleft() for _ in range(batch_size))
+        return pending
+
+    def __append_batch(self, items: Iterable[str]) -> None:
+        num_items = len(self.__items)
+        self.__items.extend(items)
+        num_items = len(self.__items) - num_items
+        if num_items:
+            self.__unfinished_tasks += num_items
+            self.__finished.clear()
+            self.__wakeup_getters(num_items)
+
+    def __wakeup_getters(self, num_items: int) -> None:
+        while num_items and self.__getters:
+            getter = self.__getters.popleft()
+            if not getter.done():
+                getter.set_result(None)
+                num_items -= 1
+
+    async def get(self) -> str:
+        while not self.__items:
+            getter = asyncio.get_running_loop().create_future()
+            self.__getters.append(getter)
+            try:
+                await getter
+            except asyncio.CancelledError:
+                try:
+                    self.__getters.remove(getter)
+                except ValueError:
+                    pass
+                # If this getter was woken and then cancelled, hand its
+                # wakeup on so the item is not stranded.
+                if self.__items and not getter.cancelled():
+                    self.__wakeup_getters(1)
+                raise
+        item = self.__items.popleft()
+        self.__not_full.set()
+        return item
+
+    def get_nowait(self) -> str:
+        if not self.__items:
+            raise asyncio.QueueEmpty
+        item = self.__items.popleft()
+        self.__not_full.set()
+        return item
+
+    def task_done(self) -> None:
+        self.__unfinished_tasks -= 1
+        if self.__unfinished_tasks == 0:
+            self.__finished.set()
+
+    async def join(self) -> None:
+        await self.__finished.wait()
+
+
 async def set_up_tasks(
         root_url: str, num_workers: int,
         output_page_and_links_function: Callable[[str, Set[str]], str]) -> None:
+    # On Python 3.12+ eager tasks run their first step synchronously,
+    # skipping an event-loop round trip per task.
+    if hasattr(asyncio, 'eager_task_factory'):
+        asyncio.get_running_loop().set_task_factory(
+            asyncio.eager_task_factory)
+
     # An async queue to hold the page links for processing by worker tasks.
-    queue = asyncio.Queue()
-    # A set to dedup page links.
-    enqueued = set()
+    queue = LinkQueue(maxsize=num_workers * QUEUE_ITEMS_PER_WORKER)
+    # A Bloom-filter-backed set to dedup page links without holding
+    # every url seen in memory as a full string.
+    enqueued = SeenSet()
+    # Normalize the root so it matches links back to itself later on.
+    root_url = normalize_url(root_url)
     queue.put_nowait(root_url)
     enqueued.add(root_url)
 
-    async with aiohttp.ClientSession() as session:
-        workers = [Worker(queue, enqueued, session,
-                          output_page_and_links_function)
-                   for _ in range(num_workers)]
-        for worker in workers:
-            worker.start()
-        all_tasks = [worker.task for worker in workers] + [monitor(workers),]
-        await asyncio.gather(*all_tasks)
+    # A single pooled session shared by all workers, so TCP/TLS handshakes
+    # and DNS lookups are amortized across every fetch on the same host.
+    # AsyncResolver (aiodns/c-ares) keeps DNS lookups off the default
+    # thread pool; combined with the connector's DNS cache, repeat
+    # connects to the crawled host skip DNS entirely.
+    connector = aiohttp.TCPConnector(
+        limit=num_workers * 4,
+        limit_per_host=num_workers,
+        ttl_dns_cache=DNS_CACHE_TTL_SECS,
+        use_dns_cache=True,
+        keepalive_timeout=KEEPALIVE_TIMEOUT_SECS,
+        enable_cleanup_closed=True,
+        resolver=AsyncResolver(),
+        family=socket.AF_INET)
+    # Caps concurrent fetches independently of the worker count.
+    fetch_semaphore = asyncio.Semaphore(num_workers * FETCHES_PER_WORKER)
+
+    # Page parsing is CPU-bound Python which would otherwise hold the
+    # GIL on the event-loop thread; a process pool spreads it over the
+    # cores while the loop keeps pumping sockets.
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=os.cpu_count()) as parse_executor:
+        async with aiohttp.ClientSession(
+                connector=connector, timeout=REQUEST_TIMEOUT) as session:
+            workers = [Worker(queue, enqueued, session, fetch_semaphore,
+                              parse_executor,
+                              output_page_and_links_function)
+                       for _ in range(num_workers)]
+            # The TaskGroup gives structured shutdown: leaving the block
+            # waits for the cancelled worker tasks, and any unexpected
+            # worker exception cancels the rest of the crawl.
+            async with asyncio.TaskGroup() as task_group:
+                for worker in workers:
+                    worker.start(task_group)
+                # Block until every enqueued page has been processed,
+                # then shut the workers down.
+                await queue.join()
+                for worker in workers:
+                    worker.stop()
+
+
+class WorkerState(enum.IntEnum):
+    """The states a Worker moves through while processing the queue."""
+    UNSPECIFIED = 0
+    AWAITING_PAGE_GET = 1
+    AWAITING_QUEUE = 2
 
 
 class Worker:
     """A worker which extracts link URLs from the pages on the queue."""
-    STATE_UNSPECIFIED = 0
-    STATE_AWAITING_PAGE_GET = 1
-    STATE_AWAITINMG_QUEUE = 2
 
-    def __init__(self, queue: asyncio.Queue, enqueued: Set[str],
+    # Workers live for the whole crawl and their attributes are read in
+    # the hot processing loop; slots make those loads a fixed-offset
+    # lookup and drop the per-instance __dict__.
+    __slots__ = ('__state', '__queue', '__enqueued', '__session',
+                 '__fetch_semaphore', '__parse_executor',
+                 '__output_page_and_links', '__pending', '__task')
+
+    def __init__(self, queue: LinkQueue, enqueued: SeenSet,
                  session: aiohttp.ClientSession,
+                 fetch_semaphore: asyncio.Semaphore,
+                 parse_executor: concurrent.futures.Executor,
                  output_page_and_links_function: Callable[[str, Set[str]], str]
                  ) -> None:
-        self.__state = self.STATE_UNSPECIFIED
+        self.__state = WorkerState.UNSPECIFIED
         self.__queue = queue
         self.__enqueued = enqueued
         self.__session = session
+        self.__fetch_semaphore = fetch_semaphore
+        self.__parse_executor = parse_executor
         self.__output_page_and_links = output_page_and_links_function
+        # New links that did not fit on the bounded queue; flushed back
+        # onto it as the crawl makes room.
+        self.__pending = collections.deque()
 
     @property
-    def state(self) -> int:
+    def state(self) -> WorkerState:
         return self.__state
 
     @property
     def task(self) -> asyncio.Task:
         return self.__task
 
-    def start(self) -> None:
-        self.__task = asyncio.create_task(self.run())
+    def start(self, task_group: asyncio.TaskGroup) -> asyncio.Task:
+        self.__task = task_group.create_task(self.run())
+        return self.__task
 
     def stop(self) -> None:
         self.__task.cancel()
@@ -85,53 +341,191 @@ class Worker:
             await self.process_queue_item()
 
     async def process_queue_item(self) -> None:
-        self.__state = self.STATE_AWAITINMG_QUEUE
-        url = await self.__queue.get()
-
-        self.__state = self.STATE_AWAITING_PAGE_GET
-        links_set = await get_page_links(
-            self.__session, url)
-        self.__output_page_and_links(url, links_set)
-
-        self.__state = self.STATE_UNSPECIFIED
-        for link in sorted(links_set):
-            if link not in self.__enqueued:
-                self.__queue.put_nowait(link)
-                self.__enqueued.add(link)
-        self.__queue.task_done()
-
-
-async def get_page_links(session: aiohttp.ClientSession, url: str) -> Set[str]:
-    async with session.get(url) as response:
-        if not response.headers['content-type'].startswith('text/html'):
-            return set()
-
-        html = await response.text()
-        links_set = extract_links_from_page(url, html)
-        return links_set
+        self.__state = WorkerState.AWAITING_QUEUE
+        self.__flush_pending()
+        urls = await self.__drain(WORKER_BATCH_SIZE)
+
+        # Note, task_done must be called for every drained url on every
+        # code path, otherwise queue.join() in set_up_tasks would never
+        # unblock.
+        try:
+            self.__state = WorkerState.AWAITING_PAGE_GET
+            links_sets = await asyncio.gather(
+                *[get_page_links(self.__session, self.__fetch_semaphore,
+                                 self.__parse_executor, url)
+                  for url in urls])
+
+            self.__state = WorkerState.UNSPECIFIED
+            for url, links_set in zip(urls, links_sets):
+                self.__output_page_and_links(url, links_set)
+            self.__enqueue_new_links(
+                link for links_set in links_sets for link in links_set)
+        finally:
+            for _ in urls:
+                self.__queue.task_done()
+
+    def __enqueue_new_links(self, links: Iterable[str]) -> None:
+        """Marks links as seen and enqueues the ones that are new.
+
+        SeenSet.add reports whether each url is new, folding the
+        membership check and the insert into one probe, and the new
+        links go to the queue in a single batched put. Queue order does
+        not affect crawl coverage, so the links are not sorted.
+        """
+        self.__pending.extend(
+            link for link in links if self.__enqueued.add(link))
+        self.__flush_pending()
+
+    def __flush_pending(self) -> None:
+        """Moves pending links onto the queue, as many as fit.
+
+        Leftovers stay buffered here rather than blocking: the workers
+        are the queue's only consumers, so a worker waiting for queue
+        space would wait forever once every other worker did the same.
+        Links only ever spill while the queue is full, so queue.join()
+        cannot fire with a link still buffered — a full queue means
+        unfinished tasks, and this flush runs again before the next get.
+        """
+        if self.__pending:
+            self.__pending = self.__queue.put_many_nowait(self.__pending)
+
+    async def __drain(self, max_items: int) -> List[str]:
+        """Takes one queued url, plus immediately available extras.
+
+        Only the first url is awaited; the rest of the batch is whatever
+        the queue can hand over without blocking, up to max_items.
+        """
+        urls = [await self.__queue.get()]
+        while len(urls) < max_items:
+            try:
+                urls.append(self.__queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        return urls
+
+
+async def get_page_links(session: aiohttp.ClientSession,
+                         fetch_semaphore: asyncio.Semaphore,
+                         parse_executor: concurrent.futures.Executor,
+                         url: str) -> Set[str]:
+    # The semaphore is held for the fetch only, so parsing below does not
+    # count against the in-flight request limit.
+    async with fetch_semaphore:
+        async with session.get(url) as response:
+            if response.content_type != 'text/html':
+                return _EMPTY_LINKS
+
+            # Read at most MAX_PAGE_BYTES and decode with the declared
+            # charset. This caps memory per page and avoids
+            # response.text()'s encoding detection scan over the whole
+            # body.
+            raw_html = await response.content.read(MAX_PAGE_BYTES)
+            html = raw_html.decode(response.charset or 'utf-8',
+                                   errors='replace')
+
+    # Parse off the event loop so that the other workers' network I/O is
+    # not starved while the regex scan or HTML parser runs.
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        parse_executor, extract_links_from_page, url, html)
 
 
 def extract_links_from_page(page_url: str, html: str) -> Set[str]:
-    site_name = urlparse(page_url).netloc
-    page_soup = BeautifulSoup(html, 'html.parser')
-    href_list = [a['href']
-                 for a in page_soup.find_all('a') if a.has_attr('href')]
+    # yarl parses in C and caches components, unlike stdlib urlparse.
+    # Interning the site name makes the lru_cache lookup in
+    # _same_site_matcher a pointer comparison, since every page of a
+    # crawl shares one host.
+    site_name = sys.intern(yarl.URL(page_url).raw_authority)
+    # The base url is constant for the whole page, so look it up once
+    # rather than once per link. A <base> without an href is ignored.
+    base_url = page_url
+    href_list = _A_HREF_RE.findall(html)
+    if href_list:
+        base_match = _BASE_HREF_RE.search(html)
+        if base_match:
+            base_url = base_match.group(1)
+    else:
+        # The regex found nothing; re-check with a real parser in case
+        # the page uses unquoted hrefs or other markup the fast path
+        # does not cover.
+        tree = LexborHTMLParser(html)
+        base_tag = tree.css_first('base[href]')
+        # A valueless href attribute comes back as None; treat it like a
+        # missing one.
+        if base_tag and base_tag.attributes['href']:
+            base_url = base_tag.attributes['href']
+        href_list = [a.attributes['href'] for a in tree.css('a[href]')
+                     if a.attributes['href']]
+        if not href_list:
+            return _EMPTY_LINKS
     links_set = set()
+    same_site = _same_site_matcher(site_name).match
     for link_url in href_list:
-        parsed_url = urlparse(link_url)
-        if (parsed_url.scheme in ['', 'http', 'https'] and
-                parsed_url.netloc in ['', site_name]):
-            links_set.add(resolve_link_url(page_url, page_soup, link_url))
-    return links_set
-
-
-def resolve_link_url(page_url: str, page_soup: BeautifulSoup,
-                     link_url: str) -> str:
-    base_tag = page_soup.find('base')
-    base_url = base_tag['href'] if base_tag else page_url
-    resolved_link_url = urljoin(base_url, link_url)
-    defragged_link_url = urldefrag(resolved_link_url).url
-    return defragged_link_url
+        if same_site(link_url):
+            links_set.add(resolve_link_url(base_url, link_url))
+    return links_set or _EMPTY_LINKS
+
+
+_DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+# The only schemes the crawler follows. A startswith against this tuple
+# is far cheaper than urlsplit-ing the link just to inspect its scheme.
+_CRAWLABLE_PREFIXES = ('http://', 'https://')
+
+# Hrefs containing any of these need urljoin's full resolution logic.
+_SLOW_JOIN_MARKERS = ('..', ';', '?', '#', ':')
+
+
+def resolve_link_url(base_url: str, link_url: str) -> str:
+    return normalize_url(_fast_join(base_url, link_url))
+
+
+def _fast_join(base_url: str, link_url: str) -> str:
+    """Joins link_url to base_url, specialized for the common cases.
+
+    Absolute links, absolute paths and plain relative paths — the vast
+    majority of real hrefs — are joined with a couple of string
+    operations. Anything else (dot segments, queries, fragments,
+    protocol-relative or exotic forms) falls back to urljoin.
+    """
+    if link_url.startswith(_CRAWLABLE_PREFIXES):
+        return link_url
+    # A query or fragment on the base changes how relative paths resolve
+    # (a raw '/' inside a query is not a path separator), and can reach
+    # here unnormalized via a <base href> tag.
+    if (not link_url or link_url.startswith('//') or
+            '?' in base_url or '#' in base_url or
+            any(marker in link_url for marker in _SLOW_JOIN_MARKERS)):
+        return urljoin(base_url, link_url)
+    authority_start = base_url.find('://') + 3
+    if authority_start == 2:  # No scheme on the base url.
+        return urljoin(base_url, link_url)
+    path_start = base_url.find('/', authority_start)
+    if link_url.startswith('/'):
+        authority = base_url[:path_start] if path_start != -1 else base_url
+        return authority + link_url
+    if path_start == -1:
+        return base_url + '/' + link_url
+    return base_url[:base_url.rfind('/') + 1] + link_url
+
+
+def normalize_url(url: str) -> str:
+    """Returns a canonical form of url.
+
+    Mixed-case schemes and hosts, explicit default ports, dot segments
+    and trailing slashes in paths, unsorted query parameters and
+    fragments all produce trivially-equivalent urls; normalizing them
+    away dedups such variants to a single entry and a single fetch.
+    """
+    parsed_url = urlsplit(url)
+    scheme = parsed_url.scheme.lower()
+    host = (parsed_url.hostname or '').lower()
+    port = ('' if parsed_url.port in (None, _DEFAULT_PORTS.get(scheme))
+            else f':{parsed_url.port}')
+    path = posixpath.normpath(parsed_url.path) if parsed_url.path else '/'
+    query = urlencode(sorted(parse_qsl(parsed_url.query,
+                                       keep_blank_values=True)))
+    return urlunsplit((scheme, host + port, path, query, ''))
 
 
 def print_page_and_links(page_url: str, links_set: Set[str]) -> None:
@@ -145,27 +539,18 @@ def print_page_and_links(page_url: str, links_set: Set[str]) -> None:
         print()
 
 
-async def monitor(workers: List[Worker]) -> None:
-    """A monitor task which stops the crawl when no more links are available."""
-    while True:
-        # Note, monitor must yield first in order to give the workers a chance
-        # to get their first url off the queue.
-        await asyncio.sleep(MONITOR_SLEEP_MS / 1000)
-
-        if all([worker.state is Worker.STATE_AWAITINMG_QUEUE
-                for worker in workers]):
-            break
-
-    for worker in workers:
-        worker.stop()
-
-
 def main(unused_argv: List[str]):
     try:
-        asyncio.run(set_up_tasks(FLAGS.root_url, FLAGS.num_workers,
-                                 print_page_and_links))
-    except asyncio.CancelledError:
-        print('Done')
+        # uvloop's C event loop is substantially faster than the default
+        # selector loop; fall back silently where it is unavailable
+        # (e.g. Windows).
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+    asyncio.run(set_up_tasks(FLAGS.root_url, FLAGS.num_workers,
+                             print_page_and_links))
+    print('Done')
 
 
 if __name__ == '__main__':
@@ -2,7 +2,7 @@
 
 import aiohttp
 import asyncio
-from bs4 import BeautifulSoup
+import collections
 import crawler
 import pytest
 from unittest.mock import patch, AsyncMock, MagicMock, Mock
@@ -12,48 +12,74 @@ class TestResolveLinkUrl:
     """Test suite for the resolve_link_url function."""
 
     def test_resolves_absolute_url(self):
-        page_url = 'http://www.joanorr.com/baz/boz.html'
-        page_soup = BeautifulSoup('<a href="{url}"></a>', 'html.parser')
+        base_url = 'http://www.joanorr.com/baz/boz.html'
         link_url = 'http://www.joanorr.com/foo/bar.html'
 
-        assert (crawler.resolve_link_url(page_url, page_soup, link_url) ==
+        assert (crawler.resolve_link_url(base_url, link_url) ==
                 'http://www.joanorr.com/foo/bar.html')
 
     def test_resolves_absolute_path_url(self):
-        page_url = 'http://www.joanorr.com/baz/boz.html'
-        page_soup = BeautifulSoup('<a href="{url}"></a>', 'html.parser')
+        base_url = 'http://www.joanorr.com/baz/boz.html'
         link_url = '/foo/bar.html'
 
-        assert (crawler.resolve_link_url(page_url, page_soup, link_url) ==
+        assert (crawler.resolve_link_url(base_url, link_url) ==
                 'http://www.joanorr.com/foo/bar.html')
 
-    def test_resolves_relative_path_url_no_base_tag(self):
-        page_url = 'http://www.joanorr.com/baz/boz.html'
-        page_soup = BeautifulSoup('<a href="{url}"></a>', 'html.parser')
+    def test_resolves_relative_path_url(self):
+        base_url = 'http://www.joanorr.com/baz/boz.html'
         link_url = 'foo/bar.html'
 
-        assert (crawler.resolve_link_url(page_url, page_soup, link_url) ==
+        assert (crawler.resolve_link_url(base_url, link_url) ==
                 'http://www.joanorr.com/baz/foo/bar.html')
 
-    def test_resolves_relative_path_url_with_base_tag(self):
-        base_url = 'http://www.joanorr.com/new_base/index.html'
-        page_url = 'http://www.joanorr.com/baz/boz.html'
-        page_soup = BeautifulSoup(
-            '<base href="{base_url}"><a href="{url}"></a>', 'html.parser')
-        link_url = 'http://www.joanorr.com/new_base/foo/bar.html'
+    def test_canonicalizes_host_case_and_default_port(self):
+        base_url = 'http://www.joanorr.com/baz/boz.html'
+        link_url = 'HTTP://WWW.JOANORR.COM:80/foo/bar.html'
 
-        assert (crawler.resolve_link_url(page_url, page_soup, link_url) ==
-                'http://www.joanorr.com/new_base/foo/bar.html')
+        assert (crawler.resolve_link_url(base_url, link_url) ==
+                'http://www.joanorr.com/foo/bar.html')
+
+    def test_canonicalizes_empty_path(self):
+        base_url = 'http://www.joanorr.com/baz/boz.html'
+        link_url = 'http://www.joanorr.com'
+
+        assert (crawler.resolve_link_url(base_url, link_url) ==
+                'http://www.joanorr.com/')
+
+    def test_resolves_relative_path_against_base_with_query(self):
+        base_url = 'http://www.joanorr.com/baz/?v=/z'
+        link_url = 'foo.html'
+
+        assert (crawler.resolve_link_url(base_url, link_url) ==
+                'http://www.joanorr.com/baz/foo.html')
 
     def test_discards_url_fragment(self):
-        page_url = 'http://www.joanorr.com/baz/boz.html'
-        page_soup = BeautifulSoup('<a href="{url}"></a>', 'html.parser')
+        base_url = 'http://www.joanorr.com/baz/boz.html'
         link_url = 'http://www.joanorr.com/foo/bar.html#tab=5'
 
-        assert (crawler.resolve_link_url(page_url, page_soup, link_url) ==
+        assert (crawler.resolve_link_url(base_url, link_url) ==
                 'http://www.joanorr.com/foo/bar.html')
 
 
+class TestNormalizeUrl:
+    """Test suite for the normalize_url function."""
+
+    def test_collapses_trivially_equivalent_variants(self):
+        urls = ['http://x/a', 'HTTP://x:80/a/', 'http://x/a#t']
+
+        normalized = set(crawler.normalize_url(url) for url in urls)
+
+        assert normalized == set(['http://x/a'])
+
+    def test_normalizes_dot_segments_in_path(self):
+        assert (crawler.normalize_url('http://x/a/../b/./c.html') ==
+                'http://x/b/c.html')
+
+    def test_sorts_query_parameters(self):
+        assert (crawler.normalize_url('http://x/a?b=2&a=1') ==
+                'http://x/a?a=1&b=2')
+
+
 class TestExtractLinksFromPage:
     """Test suite for the extract_links_from_page function."""
 
@@ -101,6 +127,31 @@ class TestExtractLinksFromPage:
 
         assert actual_result == expected_result
 
+    def test_resolves_relative_links_against_base_tag(self):
+        html = """
+          <base href="http://www.joanorr.com/new_base/index.html">
+          <a href="baz.html">Link 1</a>
+        """
+        expected_result = set([
+            'http://www.joanorr.com/new_base/baz.html',
+        ])
+
+        actual_result = crawler.extract_links_from_page(self.PAGE_URL, html)
+
+        assert actual_result == expected_result
+
+    def test_includes_links_with_unquoted_hrefs(self):
+        html = """
+          <a href=baz.html>Link 1</a>
+        """
+        expected_result = set([
+            'https://www.joanorr.com/foo/baz.html',
+        ])
+
+        actual_result = crawler.extract_links_from_page(self.PAGE_URL, html)
+
+        assert actual_result == expected_result
+
     def test_ignores_anchors_without_href_attributes(self):
         html = """
           <a href="baz.html">Link 1</a>
@@ -115,148 +166,307 @@ class TestExtractLinksFromPage:
         assert actual_result == expected_result
 
 
-@pytest.fixture
-async def mock_asyncio_gather():
-    return 'foo'
+class TestSeenSet:
+    """Test suite for the SeenSet class."""
+
+    def test_add_returns_true_only_for_new_urls(self):
+        seen = crawler.SeenSet()
+
+        assert seen.add('http://www.joanorr.com/')
+        assert not seen.add('http://www.joanorr.com/')
+
+    def test_contains_seeded_urls(self):
+        seen = crawler.SeenSet(['index.html'])
+
+        assert 'index.html' in seen
+        assert 'foo.html' not in seen
+
+
+class TestLinkQueue:
+    """Test suite for the LinkQueue class."""
+
+    @pytest.mark.asyncio
+    async def test_put_many_then_get_returns_items_in_order(self):
+        queue = crawler.LinkQueue()
+
+        await queue.put_many(['foo.html', 'bar.html'])
+
+        assert await queue.get() == 'foo.html'
+        assert await queue.get() == 'bar.html'
+
+    @pytest.mark.asyncio
+    async def test_get_waits_for_put(self):
+        queue = crawler.LinkQueue()
+        getter = asyncio.create_task(queue.get())
+        await asyncio.sleep(0)
+        assert not getter.done()
+
+        queue.put_nowait('foo.html')
+
+        assert await getter == 'foo.html'
+
+    @pytest.mark.asyncio
+    async def test_get_nowait_raises_when_empty(self):
+        queue = crawler.LinkQueue()
+        queue.put_nowait('foo.html')
+
+        assert queue.get_nowait() == 'foo.html'
+        with pytest.raises(asyncio.QueueEmpty):
+            queue.get_nowait()
+
+    @pytest.mark.asyncio
+    async def test_put_wakes_only_as_many_getters_as_items(self):
+        queue = crawler.LinkQueue()
+        getters = [asyncio.create_task(queue.get()) for _ in range(2)]
+        await asyncio.sleep(0)
+
+        queue.put_nowait('foo.html')
+        await asyncio.sleep(0)
+
+        # One item wakes exactly one of the two waiting getters.
+        assert sum(getter.done() for getter in getters) == 1
+
+        queue.put_nowait('bar.html')
+        await asyncio.sleep(0)
+        results = {await getter for getter in getters}
+        assert results == {'foo.html', 'bar.html'}
+
+    @pytest.mark.asyncio
+    async def test_put_many_applies_backpressure_when_full(self):
+        queue = crawler.LinkQueue(maxsize=1)
+        putter = asyncio.create_task(queue.put_many(['foo.html', 'bar.html']))
+        await asyncio.sleep(0)
+        assert not putter.done()
+
+        assert await queue.get() == 'foo.html'
+        await putter
+        assert await queue.get() == 'bar.html'
+
+    @pytest.mark.asyncio
+    async def test_join_unblocks_when_all_tasks_are_done(self):
+        queue = crawler.LinkQueue()
+        await queue.put_many(['foo.html', 'bar.html'])
+        await queue.get()
+        await queue.get()
+        joiner = asyncio.create_task(queue.join())
+        await asyncio.sleep(0)
+
+        queue.task_done()
+        await asyncio.sleep(0)
+        assert not joiner.done()
+
+        queue.task_done()
+        await joiner
 
 
 @pytest.mark.asyncio
-@patch('asyncio.gather', new_callable=AsyncMock)
-@patch('crawler.monitor')
+@patch('aiohttp.TCPConnector')
+@patch('aiohttp.ClientSession')
+@patch('crawler.LinkQueue')
 @patch('crawler.Worker')
-async def test_worker(MockWorker, mock_monitor, mock_asyncio_gather):
+async def test_worker(MockWorker, MockQueue, MockClientSession,
+                      MockTCPConnector):
     root_url = 'http://www.example.com/'
     num_workers = 3
+    queue = MockQueue.return_value
+    queue.join = AsyncMock()
 
     await crawler.set_up_tasks(root_url, num_workers,
                                crawler.print_page_and_links)
 
-    # The right number of Workers have been created
-    assert MockWorker.call_count == num_workers
+    # The root url has been enqueued
+    queue.put_nowait.assert_called_once_with(root_url)
 
-    # The monitor has been started and passed the workers
-    assert mock_monitor.call_count == 1
-    mock_monitor_args = mock_monitor.call_args.args
-    assert len(mock_monitor_args) == 1
-    assert len(mock_monitor_args[0]) == num_workers
-    assert "name='Worker()'" in repr(mock_monitor_args[0][0])
-    assert "name='Worker()'" in repr(mock_monitor_args[0][1])
-    assert "name='Worker()'" in repr(mock_monitor_args[0][2])
+    # A single pooled session is shared by all the workers
+    assert MockClientSession.call_count == 1
+
+    # The right number of Workers have been created and started within
+    # a task group
+    assert MockWorker.call_count == num_workers
+    assert MockWorker.return_value.start.call_count == num_workers
+    start_args = MockWorker.return_value.start.call_args.args
+    assert isinstance(start_args[0], asyncio.TaskGroup)
 
-    # The worker tasks have been gathered
-    assert mock_asyncio_gather.call_count == 1
-    mock_asyncio_gather_args = mock_asyncio_gather.call_args.args
-    assert len(mock_asyncio_gather_args) == 4
-    assert "name='Worker().task'" in repr(mock_asyncio_gather_args[0])
-    assert "name='Worker().task'" in repr(mock_asyncio_gather_args[1])
-    assert "name='Worker().task'" in repr(mock_asyncio_gather_args[2])
+    # The crawl blocks on the queue being fully processed, then the
+    # workers are stopped
+    queue.join.assert_awaited_once()
+    assert MockWorker.return_value.stop.call_count == num_workers
 
 
 @patch.object(crawler.Worker, 'run')
-@patch('asyncio.create_task')
 @patch('aiohttp.ClientSession')
-@patch('asyncio.Queue')
-def test_worker_starts_task(MockQueue, MockClientSession, mock_create_task,
+@patch('crawler.LinkQueue')
+def test_worker_starts_task(MockQueue, MockClientSession,
                             mock_crawler_worker_run):
     queue = MockQueue()
     enqueued = set()
     session = MockClientSession()
-    worker = crawler.Worker(queue, enqueued, session,
-                            crawler.print_page_and_links)
+    task_group = MagicMock()
+    worker = crawler.Worker(queue, enqueued, session, asyncio.Semaphore(5),
+                            None, crawler.print_page_and_links)
 
-    mock_create_task.assert_not_called()
+    task_group.create_task.assert_not_called()
     mock_crawler_worker_run.assert_not_called()
-    worker.start()
+    worker.start(task_group)
 
-    mock_create_task.assert_called_once()
+    task_group.create_task.assert_called_once()
     mock_crawler_worker_run.assert_called_once()
 
 
 @patch.object(crawler.Worker, 'run')
-@patch('asyncio.create_task')
 @patch('aiohttp.ClientSession')
-@patch('asyncio.Queue')
-def test_worker_stops_task(MockQueue, MockClientSession, mock_create_task,
+@patch('crawler.LinkQueue')
+def test_worker_stops_task(MockQueue, MockClientSession,
                            mock_crawler_worker_run):
     queue = MockQueue()
     enqueued = set()
     session = MockClientSession()
-    worker = crawler.Worker(queue, enqueued, session,
-                            crawler.print_page_and_links)
-    worker.start()
+    task_group = MagicMock()
+    worker = crawler.Worker(queue, enqueued, session, asyncio.Semaphore(5),
+                            None, crawler.print_page_and_links)
+    worker.start(task_group)
 
-    mock_create_task().cancel.assert_not_called()
+    task_group.create_task.return_value.cancel.assert_not_called()
     worker.stop()
 
-    mock_create_task().cancel.assert_called_once()
+    task_group.create_task.return_value.cancel.assert_called_once()
 
 
 @pytest.mark.asyncio
 @patch('crawler.get_page_links')
 @patch('aiohttp.ClientSession')
-@patch('asyncio.Queue')
+@patch('crawler.LinkQueue')
 async def test_worker_processes_queue(MockQueue, MockClientSession,
                                       mock_get_page_links):
     session = MockClientSession()
     queue = MockQueue()
     queue.get = AsyncMock(return_value='index.html')
-    enqueued = set(['index.html'])
+    queue.get_nowait = Mock(side_effect=asyncio.QueueEmpty)
+    queue.put_many_nowait = Mock(return_value=collections.deque())
+    enqueued = crawler.SeenSet(['index.html'])
     mock_get_page_links.return_value = set(['foo.html', 'bar.html'])
 
-    worker = crawler.Worker(queue, enqueued, session,
-                            crawler.print_page_and_links)
+    worker = crawler.Worker(queue, enqueued, session, asyncio.Semaphore(5),
+                            None, crawler.print_page_and_links)
 
     await worker.process_queue_item()
 
-    assert enqueued == set(['index.html', 'foo.html', 'bar.html'])
-    assert queue.put_nowait.call_count == 2
-    assert queue.put_nowait.call_args_list[0].args[0] == 'bar.html'
-    assert queue.put_nowait.call_args_list[1].args[0] == 'foo.html'
+    assert 'foo.html' in enqueued
+    assert 'bar.html' in enqueued
+    assert queue.put_many_nowait.call_count == 1
+    put_args = set(queue.put_many_nowait.call_args.args[0])
+    assert put_args == set(['foo.html', 'bar.html'])
 
 
 @pytest.mark.asyncio
 @patch('crawler.get_page_links')
 @patch('aiohttp.ClientSession')
-@patch('asyncio.Queue')
+@patch('crawler.LinkQueue')
 async def test_worker_processes_queue_and_dedups(MockQueue, MockClientSession,
                                                  mock_get_page_links):
     session = MockClientSession()
     queue = MockQueue()
     queue.get = AsyncMock(return_value='index.html')
-    enqueued = set(['index.html'])
+    queue.get_nowait = Mock(side_effect=asyncio.QueueEmpty)
+    queue.put_many_nowait = Mock(return_value=collections.deque())
+    enqueued = crawler.SeenSet(['index.html'])
     mock_get_page_links.return_value = set(['foo.html', 'bar.html', 'foo.html'])
 
-    worker = crawler.Worker(queue, enqueued, session,
-                            crawler.print_page_and_links)
+    worker = crawler.Worker(queue, enqueued, session, asyncio.Semaphore(5),
+                            None, crawler.print_page_and_links)
 
     await worker.process_queue_item()
 
     # foo.html appears twice but is only added once
-    assert enqueued == set(['index.html', 'foo.html', 'bar.html'])
-    assert queue.put_nowait.call_count == 2
-    assert queue.put_nowait.call_args_list[0].args[0] == 'bar.html'
-    assert queue.put_nowait.call_args_list[1].args[0] == 'foo.html'
+    assert 'foo.html' in enqueued
+    assert 'bar.html' in enqueued
+    assert queue.put_many_nowait.call_count == 1
+    put_args = set(queue.put_many_nowait.call_args.args[0])
+    assert put_args == set(['foo.html', 'bar.html'])
 
 
 @pytest.mark.asyncio
 @patch('crawler.get_page_links')
 @patch('aiohttp.ClientSession')
-@patch('asyncio.Queue')
+@patch('crawler.LinkQueue')
 async def test_worker_processes_queue_does_not_revist(
         MockQueue, MockClientSession, mock_get_page_links):
     session = MockClientSession()
     queue = MockQueue()
     queue.get = AsyncMock(return_value='index.html')
-    enqueued = set(['index.html'])
+    queue.get_nowait = Mock(side_effect=asyncio.QueueEmpty)
+    queue.put_many_nowait = Mock(return_value=collections.deque())
+    enqueued = crawler.SeenSet(['index.html'])
     mock_get_page_links.return_value = set([
         'index.html', 'foo.html', 'bar.html'])
 
-    worker = crawler.Worker(queue, enqueued, session,
+    worker = crawler.Worker(queue, enqueued, session, asyncio.Semaphore(5),
+                            None, crawler.print_page_and_links)
+
+    await worker.process_queue_item()
+
+    assert 'foo.html' in enqueued
+    assert 'bar.html' in enqueued
+    assert queue.put_many_nowait.call_count == 1
+    put_args = set(queue.put_many_nowait.call_args.args[0])
+    assert put_args == set(['foo.html', 'bar.html'])
+
+
+@pytest.mark.asyncio
+@patch('crawler.get_page_links')
+@patch('aiohttp.ClientSession')
+@patch('crawler.LinkQueue')
+async def test_worker_processes_queue_in_batches(MockQueue, MockClientSession,
+                                                 mock_get_page_links):
+    session = MockClientSession()
+    queue = MockQueue()
+    queue.get = AsyncMock(return_value='index.html')
+    queue.get_nowait = Mock(side_effect=['other.html', asyncio.QueueEmpty])
+    queue.put_many_nowait = Mock(return_value=collections.deque())
+    enqueued = crawler.SeenSet(['index.html', 'other.html'])
+    mock_get_page_links.return_value = set()
+
+    worker = crawler.Worker(queue, enqueued, session, asyncio.Semaphore(5),
+                            None, crawler.print_page_and_links)
+
+    await worker.process_queue_item()
+
+    # Both drained urls are fetched in one pass and both are marked done
+    assert mock_get_page_links.await_count == 2
+    assert queue.task_done.call_count == 2
+
+
+class FakeSession:
+    """Stand-in for aiohttp.ClientSession; never actually called because
+    get_page_links is monkeypatched, but shaped like the real thing."""
+
+    async def get(self, url):
+        raise AssertionError('FakeSession.get should not be reached')
+
+
+@pytest.mark.asyncio
+async def test_worker_processes_queue_real_queue(monkeypatch):
+    # Same scenario as test_worker_processes_queue but against a real
+    # LinkQueue, so the worker's drain/enqueue/task_done interplay is
+    # exercised for real rather than through mock call records.
+    monkeypatch.setattr(
+        'crawler.get_page_links',
+        AsyncMock(return_value=set(['foo.html', 'bar.html'])))
+    queue = crawler.LinkQueue()
+    queue.put_nowait('index.html')
+    enqueued = crawler.SeenSet(['index.html'])
+
+    worker = crawler.Worker(queue, enqueued, FakeSession(),
+                            asyncio.Semaphore(5), None,
                             crawler.print_page_and_links)
 
     await worker.process_queue_item()
 
-    assert enqueued == set(['index.html', 'foo.html', 'bar.html'])
-    assert queue.put_nowait.call_count == 2
-    assert queue.put_nowait.call_args_list[0].args[0] == 'bar.html'
-    assert queue.put_nowait.call_args_list[1].args[0] == 'foo.html'
+    assert 'foo.html' in enqueued
+    assert 'bar.html' in enqueued
+    # The new links are really on the queue and index.html is done, so
+    # exactly two unfinished tasks remain.
+    assert set([queue.get_nowait(), queue.get_nowait()]) == set(
+        ['foo.html', 'bar.html'])
+    with pytest.raises(asyncio.QueueEmpty):
+        queue.get_nowait()